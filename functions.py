@@ -1,36 +1,50 @@
 import os
 import re
 import torch
+import numpy as np
 import urllib.parse
 import openai
-from nltk.tokenize import word_tokenize
-from transformers import AutoTokenizer, AutoModel, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModel
 from clickhouse_driver import Client
-from scipy.spatial.distance import cosine
-from dotenv import load_dotenv
+from clickhouse_driver import errors as clickhouse_errors
+from dotenv import dotenv_values, load_dotenv
 from stop_words import stop_words
 import logging
 import time
 import functools
 import asyncio
+import threading
+import queue
+from collections import OrderedDict
 from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-archive_base_url = os.getenv('ARCHIVE_BASE_URL')
+# Failures a database lookup is allowed to degrade on; anything else is a bug and propagates
+DB_ERRORS = (clickhouse_errors.Error, ConnectionError)
 
-if 'OPENAI_API_KEY' in os.environ:
-    del os.environ['OPENAI_API_KEY']
+# Shell variables win over .env, as in pdf_uploading.py; only OPENAI_API_KEY is
+# taken from .env first when it is set there
+load_dotenv('.env')
+dotenv_openai_key = dotenv_values('.env').get('OPENAI_API_KEY')
+if dotenv_openai_key:
+    os.environ['OPENAI_API_KEY'] = dotenv_openai_key
 
-dotenv_path = '.env'
+REQUIRED_ENV_VARS = ('CLICKHOUSE_HOST', 'CLICKHOUSE_PORT', 'CLICKHOUSE_PASSWORD',
+                     'CLICKHOUSE_DATABASE', 'ARCHIVE_BASE_URL', 'OPENAI_API_KEY')
+missing_env_vars = [name for name in REQUIRED_ENV_VARS if not os.environ.get(name)]
+if missing_env_vars:
+    raise RuntimeError(f"Missing required environment variables: {', '.join(missing_env_vars)}")
 
-if not os.path.exists(dotenv_path):
-    raise FileNotFoundError(f"The .env file at path '{dotenv_path}' does not exist.")
+CLICKHOUSE_HOST = os.environ['CLICKHOUSE_HOST']
+CLICKHOUSE_PORT = int(os.environ['CLICKHOUSE_PORT'])
+CLICKHOUSE_PASSWORD = os.environ['CLICKHOUSE_PASSWORD']
+CLICKHOUSE_DATABASE = os.environ['CLICKHOUSE_DATABASE']
+ARCHIVE_BASE_URL = os.environ['ARCHIVE_BASE_URL']
+CLICKHOUSE_POOL_SIZE = int(os.environ.get('CLICKHOUSE_POOL_SIZE', 8))
+LLAMA_MODEL = os.environ.get('LLAMA_MODEL', "meta-llama/Llama-2-7b-hf")
 
-load_dotenv(dotenv_path)
-
-openai.api_key = os.getenv('OPENAI_API_KEY')
+openai.api_key = os.environ['OPENAI_API_KEY']
 
 def timeit(func):
     @functools.wraps(func)
@@ -39,240 +53,379 @@ def timeit(func):
         result = func(*args, **kwargs)
         end_time = time.time()
         execution_time = end_time - start_time
-        print(f"Function '{func.__name__}' executed in {execution_time:.4f} seconds.")
+        logger.info(f"Function '{func.__name__}' executed in {execution_time:.4f} seconds.")
         return result
     return wrapper_timeit
 
 
 def initialize_clickhouse_connection():
-    return Client(host=os.getenv('CLICKHOUSE_HOST'),
-                  port=int(os.getenv('CLICKHOUSE_PORT')),
+    return Client(host=CLICKHOUSE_HOST,
+                  port=CLICKHOUSE_PORT,
                   secure=True,
-                  password=os.getenv('CLICKHOUSE_PASSWORD'),
-                  database=os.getenv('CLICKHOUSE_DATABASE'))
+                  password=CLICKHOUSE_PASSWORD,
+                  database=CLICKHOUSE_DATABASE,
+                  compression='lz4',
+                  # Fail slow queries fast instead of pinning a worker
+                  settings={'max_block_size': 65536, 'max_execution_time': 5})
+
+
+# Idle connections shared by all request threads. A client is checked out for one
+# request at a time (clickhouse-driver sockets aren't thread-safe); when the pool is
+# empty a new one is opened instead of waiting, and extras are closed on release.
+_client_pool = queue.LifoQueue(maxsize=CLICKHOUSE_POOL_SIZE)
+
+
+def acquire_clickhouse_client():
+    try:
+        return _client_pool.get_nowait()
+    except queue.Empty:
+        return initialize_clickhouse_connection()
+
+
+def release_clickhouse_client(client):
+    try:
+        _client_pool.put_nowait(client)
+    except queue.Full:
+        client.disconnect()
+
+
+def get_device():
+    if torch.cuda.is_available():
+        return "cuda"
+    mps = getattr(torch.backends, "mps", None)
+    if mps is not None and mps.is_available():
+        return "mps"
+    return "cpu"
 
 
 @functools.lru_cache(maxsize=None)
 def get_tokenizer_and_model():
-    tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
-    model = AutoModel.from_pretrained("bert-base-uncased")
+    device = get_device()
+    # Half precision only pays off on accelerators; CPU kernels stay in FP32.
+    dtype = torch.float16 if device != "cpu" else torch.float32
+    tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased", use_fast=True)
+    model = AutoModel.from_pretrained("bert-base-uncased", torch_dtype=dtype).to(device).eval()
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token or "[PAD]"
     return tokenizer, model
 
 
 def generate_embeddings(tokenizer, model, query):
+    """Embed a query string, or a list of queries in a single forward pass.
+
+    Returns a float32 ndarray: 1-D for a string, 2-D (one row per query) for a list.
+    """
     try:
-        inputs = tokenizer(query, return_tensors="pt", padding=True, truncation=True)
-        with torch.no_grad():
+        queries = [query] if isinstance(query, str) else list(query)
+        device = next(model.parameters()).device
+        # Queries are short; capping the length keeps mixed-length batches from padding out to 512
+        inputs = tokenizer(queries, return_tensors="pt", padding=True, truncation=True, max_length=128)
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+        with torch.inference_mode():
             outputs = model(**inputs)
-        embeddings = outputs.last_hidden_state
-        pooled_embedding = torch.mean(embeddings, dim=1)
-        pooled_embedding = pooled_embedding.squeeze().numpy().tolist()
-        return pooled_embedding
-    except Exception as e:
-        logger.error(f"Error generating embeddings: {e}")
+            # Mean-pool over real tokens only so padding doesn't skew batched queries;
+            # einsum sums the masked states without materializing a [B, L, H] product
+            hidden = outputs.last_hidden_state
+            mask = inputs["attention_mask"].to(hidden.dtype)
+            summed = torch.einsum("blh,bl->bh", hidden, mask)
+            pooled = summed.float() / mask.sum(1, keepdim=True).float().clamp(min=1)
+            # L2-normalize so the database can rank with a plain dotProduct
+            pooled = torch.nn.functional.normalize(pooled, dim=-1)
+        pooled_embeddings = pooled.cpu().numpy()
+        return pooled_embeddings[0] if isinstance(query, str) else pooled_embeddings
+    except (RuntimeError, ValueError):
+        logger.exception("embedding generation failed")
         return None
 
 
+# Mirrors splitByNonAlpha in the tokens column, which splits only on ASCII whitespace
+# and punctuation (so '_' separates words but non-ASCII letters stay inside them);
+# words are lowercased after splitting, like lowerUTF8 on the stored tokens
+WORD_RE = re.compile(r'[^\s!-/:-@\[-`{-~]+')
+STOP_WORDS = frozenset(stop_words)
+
+
 def extract_important_words(query_text):
-    words = re.findall(r'\b\w+\b', query_text.lower())
-    important_words = [word for word in words if word not in stop_words]
-    return important_words
+    words = (word.lower() for word in WORD_RE.findall(query_text))
+    return [word for word in words if word not in STOP_WORDS]
+
+
+@lru_cache(maxsize=8192)
+def build_file_url(original_filename):
+    original_filename = original_filename.split('None', 1)[-1].strip()
+    filename_without_ext = os.path.splitext(original_filename)[0]
+    parsed_url = urllib.parse.urlparse(filename_without_ext)
+    filename = parsed_url.path.split('/')[-1]
+    return f"{ARCHIVE_BASE_URL}{filename}"
+
+
+def truncate_description(full_description):
+    return (full_description[:247] + '...') if len(full_description) > 250 else full_description
+
+
+# Search SQL is built once at import; every call only binds parameters, so no
+# query strings are assembled per request. clickhouse-driver substitutes the
+# parameters on the client, so the text sent to the server still varies per query.
+# Ranking queries select (id, chunk_text, summary_id, score), best first.
+
+# Shortlist through the HNSW index (ann_idx), then re-rank it exactly.
+# On unit vectors cosineDistance orders the same as the dotProduct score.
+ANN_SQL = """
+    SELECT c.id, c.chunk_text, c.summary_id,
+           dotProduct(c.embeddings, %(q)s) AS score
+    FROM abc_chunks AS c
+    WHERE c.id IN (
+        SELECT id
+        FROM abc_chunks
+        ORDER BY cosineDistance(embeddings, %(q)s)
+        LIMIT %(candidates)s
+    )
+    ORDER BY score DESC
+    LIMIT 1 BY c.summary_id
+    LIMIT %(top_n)s
+"""
+
+# Keyword filtering rules out the HNSW index, so shortlist with the int8 scan.
+# The query's own scale is constant, so only the row scale affects ordering.
+# dotProduct widens only one step past its inputs, and Int8 x Int8 sums over 768
+# dimensions overflow Int16, so the query side is cast to Int16 (Int32 result).
+KEYWORD_INT8_SQL = """
+    SELECT c.id, c.chunk_text, c.summary_id,
+           dotProduct(c.embeddings, %(q)s) AS score
+    FROM abc_chunks AS c
+    WHERE c.id IN (
+        SELECT id
+        FROM abc_chunks
+        WHERE hasAny(tokens, %(words)s)
+        ORDER BY dotProduct(embeddings_i8, CAST(%(q_i8)s AS Array(Int16))) * embeddings_scale DESC
+        LIMIT %(candidates)s
+    )
+    ORDER BY score DESC
+    LIMIT 1 BY c.summary_id
+    LIMIT %(top_n)s
+"""
+
+# Stage 1 of the multi-stage search, both served by the tokens index.
+# The count reads no embeddings and stops once the client re-rank limit is passed.
+KEYWORD_COUNT_SQL = """
+    SELECT count()
+    FROM (
+        SELECT id
+        FROM abc_chunks
+        WHERE hasAny(tokens, %(words)s)
+        LIMIT %(limit)s
+    )
+"""
+
+KEYWORD_CANDIDATES_SQL = """
+    SELECT id, chunk_text, summary_id, embeddings
+    FROM abc_chunks
+    WHERE hasAny(tokens, %(words)s)
+    LIMIT %(limit)s
+"""
+
+# Context window and file name for the top hit: a primary-key id range on
+# abc_chunks plus a primary-key lookup on abc_table. Descriptions are left to
+# get_pdf_descriptions, which callers use only when they need them.
+TOP_CONTEXT_SQL = """
+    SELECT
+        arrayStringConcat(arrayMap(x -> x.2, arraySort(groupArray((id, chunk_text)))), ' ') AS context,
+        (SELECT any(original_filename) FROM abc_table WHERE id = %(sid)s) AS original_filename
+    FROM abc_chunks
+    WHERE summary_id = %(sid)s
+      AND id BETWEEN %(id)s - %(window)s AND %(id)s + %(window)s
+"""
 
+RANKED_SQL = {
+    "ann": ANN_SQL,
+    "keyword_int8": KEYWORD_INT8_SQL,
+}
 
-def get_surrounding_chunks_batch(client, chunk_ids, summary_ids, window_size=2):
-    chunk_ids = [chunk_ids] if not isinstance(chunk_ids, (list, tuple)) else chunk_ids
-    summary_ids = [summary_ids] if not isinstance(summary_ids, (list, tuple)) else summary_ids
 
-    
-    chunk_ids = [str(id) for id in chunk_ids]
-    summary_ids = [str(id) for id in summary_ids]
+def fetch_ranked_chunks(client, method, params, window_size=2):
+    """Run the `method` ranking from RANKED_SQL and expand it with expand_ranked_rows."""
+    return expand_ranked_rows(client, client.execute(RANKED_SQL[method], params), window_size)
 
-    chunk_ids_tuple = tuple(chunk_ids) if len(chunk_ids) > 1 else f"('{chunk_ids[0]}')"
-    summary_ids_tuple = tuple(summary_ids) if len(summary_ids) > 1 else f"('{summary_ids[0]}')"
 
-    query = f"""
-    SELECT id, chunk_text, summary_id
-    FROM abc_chunks
-    WHERE summary_id IN {summary_ids_tuple}
-      AND id >= (SELECT MIN(id) - {window_size} FROM abc_chunks WHERE id IN {chunk_ids_tuple})
-      AND id <= (SELECT MAX(id) + {window_size} FROM abc_chunks WHERE id IN {chunk_ids_tuple})
-    ORDER BY summary_id, id
+def expand_ranked_rows(client, rows, window_size=2):
+    """Turn ranked (id, chunk_text, summary_id, score) rows, best first, into
+    (chunk_text, file_url) pairs, with one TOP_CONTEXT_SQL query for the best hit.
     """
-    results = client.execute(query)
-    chunks = {}
-    for id, chunk_text, summary_id in results:
-        if summary_id not in chunks:
-            chunks[summary_id] = []
-        chunks[summary_id].append(chunk_text)
-    return {str(summary_id): ' '.join(texts) for summary_id, texts in chunks.items()}
+    if not rows:
+        return None
 
+    # Full context and file URL only for the top chunk, as before
+    top_id, top_chunk_text, top_summary_id, _ = rows[0]
+    context_params = {"sid": str(top_summary_id), "id": int(top_id), "window": int(window_size)}
+    context, original_filename = client.execute(TOP_CONTEXT_SQL, context_params)[0]
+    file_url = build_file_url(original_filename) if original_filename else None
+    chunks = [(context or top_chunk_text, file_url)]
+    for row in rows[1:]:
+        chunks.append((row[1], None))
+    return chunks
 
-@lru_cache(maxsize=1000)
-def get_original_filename(client, summary_id):
-    try:
-        query = f"SELECT original_filename FROM abc_table WHERE id = '{summary_id}' LIMIT 1"
-        result = client.execute(query)
-        if result and result[0][0]:
-            original_filename = result[0][0]
-            original_filename = original_filename.split('None', 1)[-1].strip()
-            filename_without_ext = os.path.splitext(original_filename)[0]
-            parsed_url = urllib.parse.urlparse(filename_without_ext)
-            filename = parsed_url.path.split('/')[-1]
-            file_url = f"{archive_base_url}{filename}"
-            return file_url
-        else:
-            return None
-    except Exception as e:
-        logger.error(f"Error fetching original filename: {e}")
-        return None
+
+def quantize_embedding(embedding):
+    """Symmetric int8 quantization matching the embeddings_i8 column."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    scale = max(float(np.abs(vector).max()), 1e-12) / 127
+    return np.round(vector / scale).clip(-127, 127).astype(np.int8).tolist()
+
+
+# Shortlists keep this many candidates per requested result for the exact FP32 re-rank
+SHORTLIST_FACTOR = 10
 
 
 def ann_search(client, query_embedding, window_size=2, top_n=1):
     try:
-        question_embedding_str = ','.join(map(str, query_embedding))
-        query = f"""
-        SELECT c.id, c.chunk_text, c.summary_id,
-               (dotProduct(c.embeddings, [{question_embedding_str}]) /
-               (sqrt(dotProduct(c.embeddings, c.embeddings)) * sqrt(dotProduct([{question_embedding_str}], [{question_embedding_str}])))
-                ) AS cosine_similarity
-        FROM abc_chunks AS c
-        JOIN abc_table AS a ON c.summary_id = a.id
-        ORDER BY cosine_similarity DESC
-        LIMIT {top_n}
-        """
-        sections = client.execute(query)
-        if not sections:
+        params = {
+            "q": np.asarray(query_embedding, dtype=np.float32).tolist(),
+            "candidates": int(top_n) * SHORTLIST_FACTOR,
+            "top_n": int(top_n),
+        }
+        chunks = fetch_ranked_chunks(client, "ann", params, window_size)
+        if not chunks:
             logger.info("No sections retrieved from the database.")
-            return None, None
+        return chunks
+
+    except DB_ERRORS:
+        logger.exception("vector search failed", extra={"method": "ann_search"})
+        return None
+    
 
-        # Get details only for the top chunk
-        top_id, top_chunk_text, top_summary_id, top_cosine_similarity = sections[0]
-        full_context = get_surrounding_chunks_batch(client, [top_id], [top_summary_id], window_size)
-        file_url = get_original_filename(client, top_summary_id)
+# Keyword matches up to this size are re-ranked on the client instead of in ClickHouse
+MAX_CLIENT_RERANK_CANDIDATES = 2000
 
-        chunks = [(full_context.get(str(top_summary_id), ''), file_url)]
-        pdf_filenames = [file_url] if file_url and file_url.endswith('.pdf') else []
 
-        # Add other chunks without full context or file URL
-        for section in sections[1:]:
-            id, chunk_text, summary_id, cosine_similarity = section
-            chunks.append((chunk_text, None))
+def rerank_candidates(candidates, query_embedding, top_n):
+    """Score (id, chunk_text, summary_id, embeddings) rows with one matrix-vector product.
 
-        pdf_descriptions = [get_pdf_description(client, filename) for filename in pdf_filenames[:1]]
-        return chunks, pdf_descriptions
+    Returns (id, chunk_text, summary_id, score) for the best chunk of each of the
+    top_n documents, best first.
+    """
+    ids, chunk_texts, summary_ids, embeddings = zip(*candidates)
+    scores = np.asarray(embeddings, dtype=np.float32) @ np.asarray(query_embedding, dtype=np.float32)
+    best = {}
+    for idx in np.argsort(-scores):
+        if summary_ids[idx] not in best:
+            best[summary_ids[idx]] = (ids[idx], chunk_texts[idx], summary_ids[idx], float(scores[idx]))
+            if len(best) == top_n:
+                break
+    return list(best.values())
 
-    except Exception as e:
-        logger.error(f"Error in ANN search: {e}")
-        return None, None
-    
 
 def query_clickhouse_word_with_multi_stage(client, important_words, query_embedding, top_n=1):
-    query_embedding_str = ','.join(map(str, query_embedding))
+    # Stage 1: Count chunks containing any of the keywords; embeddings are only
+    # shipped to the client when the set is small enough to re-rank there
+    keyword_params = {"words": list(important_words), "limit": MAX_CLIENT_RERANK_CANDIDATES + 1}
+    match_count = client.execute(KEYWORD_COUNT_SQL, keyword_params)[0][0]
+    if not match_count:
+        # Fallback to ANN search if no relevant chunks found
+        return ann_search(client, query_embedding, top_n=top_n)
+
+    # Stage 2: Rank or re-rank the matched chunks using semantic similarity
+    if match_count <= MAX_CLIENT_RERANK_CANDIDATES:
+        candidates = client.execute(KEYWORD_CANDIDATES_SQL, keyword_params)
+        if not candidates:
+            # Matches went away between the count and the fetch
+            return ann_search(client, query_embedding, top_n=top_n)
+        ranked = rerank_candidates(candidates, query_embedding, top_n)
+        chunks = expand_ranked_rows(client, ranked)
+    else:
+        params = {
+            "words": list(important_words),
+            "q": np.asarray(query_embedding, dtype=np.float32).tolist(),
+            "q_i8": quantize_embedding(query_embedding),
+            "candidates": int(top_n) * SHORTLIST_FACTOR,
+            "top_n": int(top_n),
+        }
+        chunks = fetch_ranked_chunks(client, "keyword_int8", params)
+    if chunks:
+        return chunks
 
-    # Stage 1: Retrieve potentially relevant chunks based on keyword matching
-    word_query = '%' + '%'.join(important_words) + '%'
-    keyword_matching_query = f"""
-    SELECT id, chunk_text, summary_id, embeddings
-    FROM abc_chunks
-    WHERE lower(chunk_text) LIKE lower('{word_query}')
-    """
-    matched_chunks = client.execute(keyword_matching_query)
-
-    if matched_chunks:
-        # Stage 2: Rank or re-rank the matched chunks using semantic similarity
-        ranked_chunks_query = f"""
-        SELECT c.id, c.chunk_text, c.summary_id,
-               (dotProduct(c.embeddings, [{query_embedding_str}]) /
-                (sqrt(dotProduct(c.embeddings, c.embeddings)) * sqrt(dotProduct([{query_embedding_str}], [{query_embedding_str}]))))
-               AS cosine_similarity
-        FROM (
-        {keyword_matching_query}
-        ) AS c
-        JOIN abc_table AS a ON c.summary_id = a.id
-        ORDER BY cosine_similarity DESC
-        LIMIT {top_n}
-        """
-        ranked_chunks = client.execute(ranked_chunks_query)
-
-        if ranked_chunks:
-            # Get details only for the top chunk
-            top_id, top_chunk_text, top_summary_id, top_cosine_similarity = ranked_chunks[0]
-            full_context = get_surrounding_chunks_batch(client, [top_id], [top_summary_id])
-            file_url = get_original_filename(client, top_summary_id)
-
-            chunks = [(full_context.get(str(top_summary_id), ''), file_url)]
-            pdf_filenames = [file_url] if file_url and file_url.endswith('.pdf') else []
-
-            # Add other chunks without full context or file URL
-            for chunk in ranked_chunks[1:]:
-                id, chunk_text, summary_id, cosine_similarity = chunk
-                chunks.append((chunk_text, None))
-
-            # Retrieve descriptions for top PDF file
-            pdf_descriptions = [get_pdf_description(client, filename) for filename in pdf_filenames[:1]]
-
-            return chunks, pdf_descriptions
-
-    # Fallback to ANN search if no relevant chunks found
     return ann_search(client, query_embedding, top_n=top_n)
 
 
-@lru_cache(maxsize=1000)
-def get_pdf_description(client, filename):
-    try:
-        filename = os.path.basename(filename)
-        if not filename.endswith(".pdf"):
-            filename += ".pdf"
-        filename = filename.replace("None", "")
+def normalize_pdf_filename(filename):
+    filename = os.path.basename(filename)
+    if not filename.endswith(".pdf"):
+        filename += ".pdf"
+    return filename.replace("None", "")
 
-        query = f"SELECT id FROM abc_table WHERE original_filename = '{filename}'"
-        result = client.execute(query)
 
-        if result:
-            summary_id = str(result[0][0])
-            summary_id = summary_id.replace("'", "''")
+# Descriptions of documents that were found, keyed by normalized filename. Failed
+# lookups and missing files are never stored, so a transient error doesn't stick.
+DESCRIPTION_CACHE_SIZE = 8192
+_description_cache = OrderedDict()
+_description_cache_lock = threading.Lock()
+
+
+def get_pdf_descriptions(client, filenames):
+    """Map each filename to a short description taken from its first chunk.
 
-            query_chunks = f"""
-                SELECT chunk_text
+    Cached descriptions are reused; the rest are resolved in one query.
+    """
+    names = {filename: normalize_pdf_filename(filename) for filename in filenames}
+    if not names:
+        return {}
+
+    found = {}
+    with _description_cache_lock:
+        for name in set(names.values()):
+            if name in _description_cache:
+                _description_cache.move_to_end(name)
+                found[name] = _description_cache[name]
+
+    missing = tuple(set(names.values()) - found.keys())
+    first_chunks = {}
+    if missing:
+        try:
+            query = """
+            SELECT a.original_filename, any(d.description)
+            FROM abc_table AS a
+            LEFT JOIN (
+                SELECT summary_id, substringUTF8(argMin(chunk_text, id), 1, 251) AS description
                 FROM abc_chunks
-                WHERE summary_id = '{summary_id}'
-                ORDER BY id ASC
-                LIMIT 1
+                WHERE summary_id IN (SELECT id FROM abc_table WHERE original_filename IN %(names)s)
+                GROUP BY summary_id
+            ) AS d ON d.summary_id = a.id
+            WHERE a.original_filename IN %(names)s
+            GROUP BY a.original_filename
             """
-            chunks_result = client.execute(query_chunks)
-            
-            if chunks_result:
-               full_description = chunks_result[0][0]
-            # Truncate the description to 300 characters and add ellipsis if needed
-               description = (full_description[:247] + '...') if len(full_description) > 250 else full_description
-               return description
-            else:
-                return "Description not found."
+            first_chunks = dict(client.execute(query, {"names": missing}))
+        except DB_ERRORS:
+            logger.exception("pdf description lookup failed")
+            return {filename: found.get(name, "Error retrieving description.")
+                    for filename, name in names.items()}
+
+    with _description_cache_lock:
+        for name, first_chunk in first_chunks.items():
+            if first_chunk:
+                found[name] = truncate_description(first_chunk)
+                _description_cache[name] = found[name]
+        while len(_description_cache) > DESCRIPTION_CACHE_SIZE:
+            _description_cache.popitem(last=False)
+
+    descriptions = {}
+    for filename, name in names.items():
+        if name in found:
+            descriptions[filename] = found[name]
+        elif name in first_chunks:
+            descriptions[filename] = "Description not found."
         else:
-            return "File not found."
+            descriptions[filename] = "File not found."
+    return descriptions
 
-    except Exception as e:
-        logger.error(f"Error querying ClickHouse: {e}")
-        return "Error retrieving description."
-    
 
 def get_random_filename(client):
     try:
         query = "SELECT original_filename FROM abc_table ORDER BY rand() LIMIT 1"
         result = client.execute(query)
         if result:
-            original_filename = result[0][0]
-            original_filename = original_filename.split('None', 1)[-1].strip()
-            filename_without_ext = os.path.splitext(original_filename)[0]
-            parsed_url = urllib.parse.urlparse(filename_without_ext)
-            filename = parsed_url.path.split('/')[-1]
-            file_url = f"{archive_base_url}{filename}"
-            return file_url
+            return build_file_url(result[0][0])
         return None
-    except Exception as e:
-        print("An error occurred while fetching a random filename:", e)
+    except DB_ERRORS:
+        logger.exception("random filename lookup failed")
         return None
 
 
@@ -304,25 +457,41 @@ def deduplicate_results(client, closest_chunks, top_n=5):
 
 
 
-def structure_sentence_with_llama(query, chunk_text, llama_tokenizer, llama_model):
+@functools.lru_cache(maxsize=None)
+def get_llama_tokenizer_and_model():
+    # Imported here so workers that never use LLaMA don't pay for it at startup
+    from transformers import AutoModelForCausalLM
+
+    device = get_device()
+    dtype = torch.float16 if device != "cpu" else torch.float32
+    llama_tokenizer = AutoTokenizer.from_pretrained(LLAMA_MODEL)
+    llama_model = AutoModelForCausalLM.from_pretrained(LLAMA_MODEL, torch_dtype=dtype).to(device).eval()
+    return llama_tokenizer, llama_model
+
+
+def structure_sentence_with_llama(query, chunk_text, llama_tokenizer=None, llama_model=None):
     try:
+        if llama_tokenizer is None or llama_model is None:
+            llama_tokenizer, llama_model = get_llama_tokenizer_and_model()
         input_prompt = f"Question: {query}\nAnswer: {chunk_text}"
-        inputs = llama_tokenizer.encode(input_prompt, return_tensors='pt')
-        outputs = llama_model.generate(inputs, max_length=100, temperature=0.01, top_p=1.0)
-        completion_text = llama_tokenizer.decode(outputs[0], skip_special_tokens=True)
+        inputs = llama_tokenizer.encode(input_prompt, return_tensors='pt').to(llama_model.device)
+        with torch.inference_mode():
+            # Greedy decoding with the KV cache; max_new_tokens leaves the prompt untruncated
+            outputs = llama_model.generate(inputs, max_new_tokens=100, do_sample=False, use_cache=True)
+        completion_text = llama_tokenizer.decode(outputs[0][inputs.shape[-1]:], skip_special_tokens=True)
         return completion_text.strip()
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    except (RuntimeError, ValueError):
+        logger.exception("llama generation failed")
         return None
 
    
-def get_structured_answer(query, chunk_text):
+async def get_structured_answer(query, chunk_text):
     try:
         messages = [
             {"role": "system", "content": "You are a helpful assistant. Your task is to find the most relevant information in the provided text to answer the user's query. Provide a concise and structured answer. But you shouldn't let them know that the text was provided to you. You should make it in such a way that the text was written by you. "},
             {"role": "user", "content": f"Query: {query}\n\nContext: {chunk_text}\n\nPlease provide a structured and concise answer to the query based on the given context."}
         ]
-        response = openai.ChatCompletion.create(
+        response = await openai.ChatCompletion.acreate(
             model="gpt-3.5-turbo",
             messages=messages,
             max_tokens=300,
@@ -333,47 +502,62 @@ def get_structured_answer(query, chunk_text):
         )
         structured_answer = response.choices[0].message.content
         return structured_answer.strip()
-    except Exception as e:
-        logger.error(f"Error in get_structured_answer: {str(e)}")
+    except openai.error.OpenAIError:
+        logger.exception("structured answer request failed")
         return "I'm sorry, There seems to be no relevant answer for your question."
 
 
+def collect_result_files(client, file_url, top_n):
+    """Pad the top file with random ones up to top_n and describe them all."""
+    full_contexts, pdf_filenames = deduplicate_results(client, [(None, file_url)], top_n=top_n)
+
+    # Ensure uniqueness of pdf_filenames
+    unique_filenames = list(dict.fromkeys(pdf_filenames))
+
+    # If we don't have enough unique filenames, add random ones
+    while len(unique_filenames) < top_n:
+        random_filename = get_random_filename(client)
+        if random_filename and random_filename not in unique_filenames:
+            unique_filenames.append(random_filename)
+
+    descriptions = get_pdf_descriptions(
+        client, [filename for filename in unique_filenames if "No additional unique file" not in filename])
+    pdf_descriptions = [descriptions.get(filename, "No additional unique description available")
+                        for filename in unique_filenames]
+    return full_contexts, unique_filenames, pdf_descriptions
+
+
+# OpenAI calls run as coroutines on one background event loop, so any number of
+# request threads can have an answer in flight without a bounded worker pool
+_llm_loop = asyncio.new_event_loop()
+threading.Thread(target=_llm_loop.run_forever, name="openai-loop", daemon=True).start()
+
+
 def process_query_clickhouse_pdf(query_text, top_n=5):
+    client = None
     try:
         tokenizer, model = get_tokenizer_and_model()
-        client = initialize_clickhouse_connection()
+        client = acquire_clickhouse_client()
 
         important_words = extract_important_words(query_text)
         if important_words:
             query_embedding = generate_embeddings(tokenizer, model, query_text)
-            closest_chunks, _ = query_clickhouse_word_with_multi_stage(client, important_words, query_embedding, top_n=1)
+            closest_chunks = query_clickhouse_word_with_multi_stage(client, important_words, query_embedding, top_n=1)
 
             if closest_chunks:
                 # Combine contexts for structured answer
                 combined_context = " ".join([chunk for chunk, _ in closest_chunks])
-                structured_answer = get_structured_answer(query_text, combined_context)
-                
-                # Use the structured answer as the only relevant chunk for further processing
-                structured_chunks = [(structured_answer, closest_chunks[0][1])]
-                
-                full_contexts, pdf_filenames = deduplicate_results(client, structured_chunks, top_n=5)
-
-                # Ensure uniqueness of pdf_filenames
-                unique_filenames = list(dict.fromkeys(pdf_filenames))
-                
-                # If we don't have enough unique filenames, add random ones
-                while len(unique_filenames) < top_n:
-                    random_filename = get_random_filename(client)
-                    if random_filename and random_filename not in unique_filenames:
-                        unique_filenames.append(random_filename)
-
-                pdf_descriptions = []
-                for filename in unique_filenames:
-                    if "No additional unique file" in filename:
-                        pdf_descriptions.append("No additional unique description available")
-                    else:
-                        description = get_pdf_description(client, filename)
-                        pdf_descriptions.append(description)
+
+                # The answer and the file lookups are independent: start the OpenAI call,
+                # do the lookups on this thread, then wait for the answer
+                answer_future = asyncio.run_coroutine_threadsafe(
+                    get_structured_answer(query_text, combined_context), _llm_loop)
+                full_contexts, unique_filenames, pdf_descriptions = collect_result_files(
+                    client, closest_chunks[0][1], top_n)
+                structured_answer = answer_future.result()
+
+                # Use the structured answer as the only relevant chunk
+                full_contexts[0] = structured_answer
 
                 # Ensure we have exactly top_n results
                 full_contexts = full_contexts[:top_n]
@@ -382,7 +566,7 @@ def process_query_clickhouse_pdf(query_text, top_n=5):
 
                 return full_contexts, unique_filenames, pdf_descriptions
             else:
-                print("No closest_chunks found, returning placeholders")
+                logger.info("No closest_chunks found, returning placeholders")
                 placeholder = "No content available"
                 placeholder_file = "No file available"
                 placeholder_desc = "No description available"
@@ -390,6 +574,10 @@ def process_query_clickhouse_pdf(query_text, top_n=5):
 
         return ["No content available"]*top_n, ["No file available"]*top_n, ["No description available"]*top_n
 
-    except Exception as e:
-        logger.error(f"Error in process_query_clickhouse_pdf: {str(e)}")
+    except Exception:
+        # Request boundary: log with traceback, the web layer shows a fallback reply
+        logger.exception("query processing failed", extra={"method": "process_query_clickhouse_pdf"})
         return None, [], []  # Return default values or handle as needed
+    finally:
+        if client is not None:
+            release_clickhouse_client(client)
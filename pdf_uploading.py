@@ -1,5 +1,5 @@
 import os
-from transformers import BertTokenizer, BertModel
+from transformers import BertTokenizerFast, BertModel
 import torch
 import nltk
 from nltk.tokenize import sent_tokenize
@@ -30,7 +30,7 @@ pdf_directory = os.getenv('PDF_DIRECTORY')
 
 
 # Initialize BERT tokenizer and model
-tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
 model = BertModel.from_pretrained('bert-base-uncased')
 
 # Table schemas
@@ -51,6 +51,10 @@ CREATE TABLE IF NOT EXISTS abc_chunks (
     summary_id UUID,
     chunk_text String,
     embeddings Array(Float32),
+    tokens Array(LowCardinality(String)) MATERIALIZED arrayMap(x -> lowerUTF8(x), splitByNonAlpha(chunk_text)),
+    embeddings_scale Float32 MATERIALIZED greatest(arrayMax(arrayMap(x -> abs(x), embeddings)), 1e-12) / 127,
+    embeddings_i8 Array(Int8) MATERIALIZED arrayMap(x -> toInt8(round(x / embeddings_scale)), embeddings),
+    INDEX tokens_idx tokens TYPE bloom_filter(0.01) GRANULARITY 1,
     PRIMARY KEY (id)
 ) ENGINE = MergeTree()
 ORDER BY id
@@ -59,9 +63,63 @@ SETTINGS
     enable_mixed_granularity_parts = 1;
 '''
 
-index_creation_query = '''
-CREATE INDEX IF NOT EXISTS hnsw_embeddings ON abc_chunks (embeddings) TYPE annoy GRANULARITY 1;
-'''
+# One-off migrations for tables created before the tokens column, the int8 embedding
+# columns and the HNSW index. Each entry is (kind, name, queries); the queries run only
+# when that column or index is missing, so regular ingest runs don't trigger
+# full-table mutations.
+migrations = [
+    ('column', 'tokens', [
+        '''
+        ALTER TABLE abc_chunks ADD COLUMN IF NOT EXISTS tokens Array(LowCardinality(String))
+        MATERIALIZED arrayMap(x -> lowerUTF8(x), splitByNonAlpha(chunk_text));
+        ''',
+    ]),
+    ('index', 'tokens_idx', [
+        '''
+        ALTER TABLE abc_chunks ADD INDEX IF NOT EXISTS tokens_idx tokens TYPE bloom_filter(0.01) GRANULARITY 1;
+        ''',
+        '''
+        ALTER TABLE abc_chunks MATERIALIZE INDEX tokens_idx;
+        ''',
+    ]),
+    ('column', 'embeddings_i8', [
+        # Rows ingested before embeddings were stored L2-normalized; must run before the
+        # int8 columns and the HNSW index are derived from them
+        '''
+        ALTER TABLE abc_chunks UPDATE embeddings = arrayMap(x -> x / L2Norm(embeddings), embeddings)
+        WHERE abs(L2Norm(embeddings) - 1) > 0.001;
+        ''',
+        '''
+        ALTER TABLE abc_chunks ADD COLUMN IF NOT EXISTS embeddings_scale Float32
+        MATERIALIZED greatest(arrayMax(arrayMap(x -> abs(x), embeddings)), 1e-12) / 127;
+        ''',
+        '''
+        ALTER TABLE abc_chunks ADD COLUMN IF NOT EXISTS embeddings_i8 Array(Int8)
+        MATERIALIZED arrayMap(x -> toInt8(round(x / embeddings_scale)), embeddings);
+        ''',
+        '''
+        ALTER TABLE abc_chunks MATERIALIZE COLUMN embeddings_i8;
+        ''',
+    ]),
+    # HNSW index used by ORDER BY cosineDistance(embeddings, ...) LIMIT k; replaces the old annoy index
+    ('index', 'ann_idx', [
+        '''
+        ALTER TABLE abc_chunks DROP INDEX IF EXISTS hnsw_embeddings;
+        ''',
+        '''
+        ALTER TABLE abc_chunks ADD INDEX IF NOT EXISTS ann_idx embeddings
+        TYPE vector_similarity('hnsw', 'cosineDistance', 768) GRANULARITY 100000000;
+        ''',
+        '''
+        ALTER TABLE abc_chunks MATERIALIZE INDEX ann_idx;
+        ''',
+    ]),
+]
+
+migration_checks = {
+    'column': "SELECT count() FROM system.columns WHERE database = currentDatabase() AND table = 'abc_chunks' AND name = %(name)s",
+    'index': "SELECT count() FROM system.data_skipping_indices WHERE database = currentDatabase() AND table = 'abc_chunks' AND name = %(name)s",
+}
 
 # Create ClickHouse tables
 def create_clickhouse_tables():
@@ -69,7 +127,12 @@ def create_clickhouse_tables():
         client = Client(host=host, port=port, secure=secure, password=password, database=database)
         client.execute(table_schema)
         client.execute(table_schema_chunks)
-        client.execute(index_creation_query)
+        for kind, name, queries in migrations:
+            if client.execute(migration_checks[kind], {'name': name})[0][0]:
+                continue
+            print(f"Migrating abc_chunks: adding {kind} {name}")
+            for query in queries:
+                client.execute(query, settings={'allow_experimental_vector_similarity_index': 1})
         client.disconnect()
     except Exception as e:
         print("Error creating ClickHouse tables:", e)
@@ -124,7 +187,9 @@ def insert_chunks(summary_id, pdf_text):
             inputs = tokenizer(concatenated_chunk, return_tensors="pt", max_length=512, truncation=True)
             with torch.no_grad():
                 outputs = model(**inputs)
-                embedding = outputs.last_hidden_state.mean(dim=1).squeeze().numpy().tolist()
+                embedding = outputs.last_hidden_state.mean(dim=1).squeeze()
+                # Store unit vectors so search can rank with a plain dotProduct
+                embedding = torch.nn.functional.normalize(embedding, dim=-1).numpy().tolist()
 
             embedding_str = json.dumps(embedding)
 